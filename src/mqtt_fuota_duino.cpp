@@ -61,17 +61,17 @@
  *   ||                       ACK FUOTA Start [device_id/ota/ack] ||
  *   ||<----------------------------------------------------------||
  *   ||                                                           ||
- *   || FW Data Block 0 [device_id/ota/data]                      ||
+ *   || FW Data Blocks 0-3 [device_id/ota/data]                   ||
  *   ||---------------------------------------------------------->||
  *   ||                                                           ||
- *   ||                   ACK FW Data Block 0 [device_id/ota/ack] ||
+ *   ||                   ACK FW Data Block 3 [device_id/ota/ack] ||
  *   ||<----------------------------------------------------------||
  *   ||                                                           ||
  *   ||                          .                                ||
  *   ||                          .                                ||
  *   ||                          .                                ||
  *   ||                                                           ||
- *   || FW Data Block N [device_id/ota/data]                      ||
+ *   || FW Data Blocks M-N [device_id/ota/data]                   ||
  *   ||---------------------------------------------------------->||
  *   ||                                                           ||
  *   ||                   ACK FW Data Block N [device_id/ota/ack] ||
@@ -350,19 +350,13 @@ void MQTTFirmwareUpdate::mqtt_msg_rx_ota_setup(uint8_t* payload,
         fw_server.size =
             big_endian_u32_read_from_array(&(payload[FW_INFO_SIZE]));
 
-        // Get and convert MD5 bytes to string of chars
-        memcpy((void*)(fw_server.md5),
-               (const void*)(&(payload[FW_INFO_MD5])),
-               (size_t)(MD5_LENGTH));
-        fw_server.md5[MD5_LENGTH] = '\0';
-    #if 0
+        // Get and convert MD5 digest bytes to string of chars
         char* ptr_fw_md5 = fw_server.md5;
-        uint8_t md5_bytes_length = (uint8_t)(MD5_LENGTH / 2U);
-        for (int i = 0; i < md5_bytes_length; i++)
+        for (uint32_t i = 0U; i < MD5_DIGEST_LENGTH; i++)
         {
-            ptr_fw_md5 += sprintf(ptr_fw_md5, "%02X", payload[i+FW_INFO_MD5]);
+            ptr_fw_md5 += sprintf(ptr_fw_md5, "%02x", payload[i+FW_INFO_MD5]);
         }
-    #endif
+        fw_server.md5[MD5_LENGTH] = '\0';
 
         Serial.printf("\n");
         debug_printf("Server FW info received:\n");
@@ -399,9 +393,12 @@ void MQTTFirmwareUpdate::mqtt_msg_rx_ota_setup(uint8_t* payload,
  * or if last available FW information in the Server has not been received or
  * the firmware version to update is lower than current one (fuota_on_progress
  * and valid_update flags). If the previous requirements are valid, then the
- * function write the recieved FW data block into the memory, count the number
- * of bytes already received and flashed, show the update progress, and check
- * if the number of bytes written are the same as the Server FW size.
+ * function parse the batch of FW data blocks of the message, write each
+ * received FW data block into the memory, count the number of bytes already
+ * received and flashed, show the update progress, and check if the number of
+ * bytes written are the same as the Server FW size. FW data blocks that are
+ * not the next one expected (duplicated or after a lost one) are ignored, and
+ * only the last FW data block written is going to be acknowledged.
  */
 void MQTTFirmwareUpdate::mqtt_msg_rx_ota_data(uint8_t* payload,
         uint32_t length)
@@ -416,18 +413,54 @@ void MQTTFirmwareUpdate::mqtt_msg_rx_ota_data(uint8_t* payload,
     if (fuota_on_progress == false)
     {   return;   }
 
-    // Parse payload and get FW block number and data
-    fw_block_n = big_endian_u32_read_from_array(&(payload[FW_BLOCK_NUM]));
-    uint8_t* fw_data = &(payload[FW_BLOCK_DATA]);
-    uint32_t fw_data_length = length - (FW_BLOCK_DATA - FW_BLOCK_NUM);
+    // Do nothing if there is not any FW data block in the message
+    if (length <= (uint32_t)(FW_BATCH_BLOCKS + FW_BLOCK_DATA))
+    {   return;   }
+    if (payload[FW_BATCH_NUM_BLOCKS] == 0U)
+    {   return;   }
+
+    // Parse batch header and get number of FW data blocks
+    uint8_t num_blocks = payload[FW_BATCH_NUM_BLOCKS];
+    uint8_t* fw_block = &(payload[FW_BATCH_BLOCKS]);
+    uint32_t remaining_length = length - FW_BATCH_BLOCKS;
 
-    // Limit bytes to write if there is coming more than expected
-    if (fw_bytes_written + fw_data_length > fw_server.size)
-    {   fw_data_length = fw_server.size - fw_bytes_written;   }
+    for (uint8_t i = 0U; i < num_blocks; i++)
+    {
+        // Stop if there is no more FW data blocks in the message
+        if (remaining_length <= (uint32_t)(FW_BLOCK_DATA))
+        {   break;   }
+
+        // Parse FW data block and get FW block number and data
+        uint32_t block_n =
+            big_endian_u32_read_from_array(&(fw_block[FW_BLOCK_NUM]));
+        uint8_t* fw_data = &(fw_block[FW_BLOCK_DATA]);
+        uint32_t fw_block_length = remaining_length - FW_BLOCK_DATA;
+        if (fw_block_length > FW_DATA_BLOCK_SIZE)
+        {   fw_block_length = FW_DATA_BLOCK_SIZE;   }
+        uint32_t fw_data_length = fw_block_length;
+
+        // Point to next FW data block of the batch
+        fw_block = fw_data + fw_block_length;
+        remaining_length = remaining_length - FW_BLOCK_DATA - fw_block_length;
+
+        // Ignore FW data blocks that are not the next one to be written
+        // (duplicated or resent blocks, or blocks after a lost one)
+        if (block_n != (fw_bytes_written / FW_DATA_BLOCK_SIZE))
+        {   continue;   }
+
+        // Limit bytes to write if there is coming more than expected
+        if (fw_bytes_written + fw_data_length > fw_server.size)
+        {   fw_data_length = fw_server.size - fw_bytes_written;   }
+
+        // Write FW data block into memory
+        num_bytes_written = Update.write(fw_data, fw_data_length);
+        fw_bytes_written = fw_bytes_written + num_bytes_written;
+        fw_block_n = block_n;
+    }
 
-    // Write FW data block into memory
-    num_bytes_written = Update.write(fw_data, fw_data_length);
-    fw_bytes_written = fw_bytes_written + num_bytes_written;
+    // Do not acknowledge anything if no FW data block has been written yet
+    if (fw_bytes_written == 0U)
+    {   return;   }
 
     // Show current update progress
     progress = (uint8_t)((100U * fw_bytes_written) / fw_server.size);
@@ -589,7 +622,8 @@ void MQTTFirmwareUpdate::handle_received_fw_data()
         ESP.restart();
     }
 
-    // Handle FW data block received acknowledge
+    // Handle FW data block received acknowledge (the Server handles it as an
+    // acknowledge of any previous FW data block too)
     if (fw_data_block_received)
     {
         fw_data_block_received = false;
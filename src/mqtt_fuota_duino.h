@@ -133,9 +133,11 @@ class MQTTFirmwareUpdate
         static const unsigned long T_SUBSCRIBE = 5000U;
 
         /**
-         * @brief MQTT Client Received messages Buffer Size.
+         * @brief MQTT Client Received messages Buffer Size (a full FW data
+         * batch frame plus MQTT header and topic).
          */
-        static constexpr uint16_t RX_BUFFER_SIZE = 1100U;
+        static constexpr uint16_t RX_BUFFER_SIZE = FW_BATCH_BLOCKS +
+            (FW_BLOCKS_PER_BATCH * (FW_BLOCK_DATA + FW_DATA_BLOCK_SIZE)) + 76U;
 
         /**
          * @brief Maximum Length of UUID ("xx:xx:xx:xx:xx:xx").
@@ -241,7 +243,8 @@ class MQTTFirmwareUpdate
         uint32_t fw_bytes_written;
 
         /**
-         * @brief Last Firmware data block received during the FUOTA process.
+         * @brief Last Firmware data block written during the FUOTA process
+         * (the one to be acknowledged).
          */
         uint32_t fw_block_n;
 
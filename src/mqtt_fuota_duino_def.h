@@ -81,7 +81,7 @@ static const uint8_t MSG_SETUP_CMD_TRIGGER_FW_UPDATE_CHECK_LENGTH = 1U;
 
 // Message to provide last stable FW information (version, size, checksum)
 static const uint8_t MSG_SETUP_CMD_LAST_FW_INFO = 0x01U;
-static const uint8_t MSG_SETUP_CMD_LAST_FW_INFO_LENGTH = 40U;
+static const uint8_t MSG_SETUP_CMD_LAST_FW_INFO_LENGTH = 24U;
 
 // Message to request the device to start the FUOTA process (listening for FW
 // data block messages
@@ -97,6 +97,15 @@ static const uint8_t FW_VERSION_LENGTH = 3U;
 // MD5 Hash algorithm string value length
 static const uint32_t MD5_LENGTH = 32U;
 
+// MD5 Hash algorithm raw digest length
+static const uint32_t MD5_DIGEST_LENGTH = 16U;
+
+// Firmware Data Block Size (Flash sector size)
+static const uint32_t FW_DATA_BLOCK_SIZE = 4096U;
+
+// Maximum number of Firmware Data Blocks sent on each data message (batch)
+static const uint8_t FW_BLOCKS_PER_BATCH = 4U;
+
 /*****************************************************************************/
 
 /* Constants - Control Message Commands (Device to Server) */
@@ -148,7 +157,7 @@ enum class t_server_request : uint8_t
 // Setup Message Fields buffer index locations
 // Last FW Info Frame:
 //   [ FW_INFO_CMD(0), FW_INFO_VER_MAJOR(1:3), FW_INFO_SIZE(4:7),
-//     FW_INFO_MD5(8:40) ]
+//     FW_INFO_MD5(8:23) ]
 enum t_msg_fw_info_field
 {
     FW_INFO_CMD = 0,
@@ -163,8 +172,17 @@ enum t_msg_fw_info_field
 };
 
 // Firmware Data Message Fields buffer index locations
+// FW Data Batch Frame:
+//   [ FW_BATCH_NUM_BLOCKS(0), FW_BATCH_BLOCKS(1:N) ]
+enum t_msg_fw_data_batch
+{
+    FW_BATCH_NUM_BLOCKS = 0,
+    FW_BATCH_BLOCKS = 1,
+};
+
+// Firmware Data Block Fields buffer index locations (inside a Batch Frame)
 // FW Data Block Frame:
-//   [ FW_BLOCK_NUM(0:3), FW_BLOCK_DATA(4:1028) ]
+//   [ FW_BLOCK_NUM(0:3), FW_BLOCK_DATA(4:4099) ]
 enum t_msg_fw_data_block
 {
     FW_BLOCK_NUM = 0,
@@ -34,17 +34,17 @@ Update Procedure:
       ||                       ACK FUOTA Start [device_id/ota/ack] ||
       ||<----------------------------------------------------------||
       ||                                                           ||
-      || FW Data Block 0 [device_id/ota/data]                      ||
+      || FW Data Blocks 0-3 [device_id/ota/data]                   ||
       ||---------------------------------------------------------->||
       ||                                                           ||
-      ||                   ACK FW Data Block 0 [device_id/ota/ack] ||
+      ||                   ACK FW Data Block 3 [device_id/ota/ack] ||
       ||<----------------------------------------------------------||
       ||                                                           ||
       ||                          .                                ||
       ||                          .                                ||
       ||                          .                                ||
       ||                                                           ||
-      || FW Data Block N [device_id/ota/data]                      ||
+      || FW Data Blocks M-N [device_id/ota/data]                   ||
       ||---------------------------------------------------------->||
       ||                                                           ||
       ||                   ACK FW Data Block N [device_id/ota/ack] ||
@@ -71,6 +71,12 @@ DATE = "14/05/2023"
 # Argument Parser Library
 from argparse import ArgumentParser
 
+# Data Classes Library
+from dataclasses import dataclass, field
+
+# Functions Tools Library
+from functools import partial
+
 # Logging Library
 import logging
 
@@ -93,12 +99,27 @@ from sys import exit as sys_exit
 # Cryptographic Library
 import hashlib
 
+# Compression Library
+import zlib
+
+# Binary Streams Library
+from io import BytesIO, SEEK_END
+
 # Time Library
 import time
 
 # Threads Library
 import threading
 
+# Queue Library
+import queue
+
+# Binary Data Packing Library
+import struct
+
+# Socket Library
+import socket
+
 
 ###############################################################################
 # Third-Party Libraries
@@ -129,6 +150,14 @@ logger = logging.getLogger(__name__)
 MQTT_HOST = "test.mosquitto.org"
 MQTT_PORT = 1883
 
+# MQTT Client limits of QoS > 0 messages in flight and queued (0: no limit)
+MQTT_MAX_INFLIGHT_MESSAGES = 100
+MQTT_MAX_QUEUED_MESSAGES = 0
+
+# MQTT Network Loop Timeout and Reconnection Delay (seconds)
+MQTT_LOOP_TIMEOUT = 1.0
+MQTT_RECONNECT_DELAY = 1.0
+
 # Topic from Server to Setup Device:
 # Trigger update check, Provide last FW version, FW update start message
 MQTT_TOPIC_PUB_OTA_SETUP = "/{}/ota/setup"
@@ -150,102 +179,186 @@ MQTT_TOPIC_SUB_OTA_ACK = "/{}/ota/ack"
 ###############################################################################
 
 # Device request a FW Update Check to get last FW information from server
-MSG_CONTROL_CMD_FW_UPDATE_CHECK = [ 0xaf, 0x12, 0x34, 0x56 ]
+MSG_CONTROL_CMD_FW_UPDATE_CHECK = bytes([ 0xaf, 0x12, 0x34, 0x56 ])
 
 # Device request to launch a FUOTA process to Server
-MSG_CONTROL_CMD_REQUEST_FW_UPDATE = [ 0x55, 0x55, 0xff, 0xff ]
+MSG_CONTROL_CMD_REQUEST_FW_UPDATE = bytes([ 0x55, 0x55, 0xff, 0xff ])
 
 # Device ready to start FUOTA process and handle reception of FW data blocks
-MSG_ACK_FUOTA_START = [ 0xaa, 0xaa, 0xaa, 0xaa ]
+MSG_ACK_FUOTA_START = bytes([ 0xaa, 0xaa, 0xaa, 0xaa ])
 
 # FUOTA process completed successfully
-MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_OK = [ 0x55, 0xaa, 0xff, 0xff ]
+MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_OK = bytes([ 0x55, 0xaa, 0xff, 0xff ])
 
 # FUOTA process completed but update on device has fail
-MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_FAIL = [ 0x55, 0xaa, 0x00, 0x00 ]
+MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_FAIL = bytes([ 0x55, 0xaa, 0x00, 0x00 ])
 
 
 ###############################################################################
 # Constants - Setup Message Commands (Server to Device)
 ###############################################################################
 
-MSG_SETUP_CMD_TRIGGER_FW_UPDATE_CHECK = [ 0x00 ]
+MSG_SETUP_CMD_TRIGGER_FW_UPDATE_CHECK = bytes([ 0x00 ])
+
+MSG_SETUP_CMD_LAST_FW_INFO = bytes([ 0x01 ])
 
-MSG_SETUP_CMD_LAST_FW_INFO = [ 0x01 ]
+# Last FW Info message frame:
+# [ CMD(1), VER_MAJOR(1), VER_MINOR(1), VER_PATCH(1), SIZE(4), MD5(16) ]
+MSG_SETUP_LAST_FW_INFO_STRUCT = struct.Struct(">BBBBI16s")
 
 # Start of FUOTA process message that provides all information of the Firmware
 # data that is going to be sent (Firmware version, size and checksum)
-MSG_SETUP_CMD_FUOTA_START = [ 0x02 ]
+MSG_SETUP_CMD_FUOTA_START = bytes([ 0x02 ])
 
 # Last Fw Version value to make the device to accept any kind of FW
 FW_VER_MAJOR_FORCE_UPDATE = 0
 FW_VER_MINOR_FORCE_UPDATE = 0
 FW_VER_PATCH_FORCE_UPDATE = 0
 
-# Firmware Data Block Size
-FW_DATA_BLOCK_SIZE = 1024
+# Firmware Data Block Size (Flash sector size)
+FW_DATA_BLOCK_SIZE = 4096
+
+# Firmware Compression Level and zlib window bits value to generate a gzip
+# stream (the format supported by ESP8266 compressed FW images)
+FW_COMPRESS_LEVEL = 9
+FW_COMPRESS_WBITS_GZIP = 31
+
+# Number of Firmware Data Blocks sent on each data message (batch)
+FW_BLOCKS_PER_BATCH = 4
+
+# Maximum number of FW data messages (batches) sent without being acknowledged
+MAX_INFLIGHT = 4
+
+# Time to wait for an ACK of FW data before resending the not acknowledged
+# FW data messages (seconds)
+FW_ACK_TIMEOUT = 10.0
 
 
 ###############################################################################
-# Globals
+# Data Types
 ###############################################################################
 
-app_exit = False
-mqtt_just_connected = False
-mqtt_msg_rx_ota_control = False
-mqtt_msg_rx_ota_ack = False
-msg_rx_payload = None
+@dataclass
+class OtaState:
+    '''
+    FUOTA process state shared between the main thread, the MQTT callbacks
+    and the termination signals handler.
+    '''
+    exit_flag: threading.Event = field(default_factory=threading.Event)
+    event_queue: queue.Queue = field(default_factory=queue.Queue)
+    topic_control: str = ""
+    topic_ack: str = ""
 
 
 ###############################################################################
 # Auxiliary Functions
 ###############################################################################
 
-def file_read(file_path: str):
-    '''Read full content of a binary file.'''
-    read_bytes = None
+def fw_compress(fw_data: bytes):
+    '''Compress FW data into a gzip stream.'''
+    compressor = zlib.compressobj(FW_COMPRESS_LEVEL, zlib.DEFLATED,
+                                  FW_COMPRESS_WBITS_GZIP)
+    return compressor.compress(fw_data) + compressor.flush()
+
+def fw_blocks_count(fw_size: int):
+    '''Get the number of FW data blocks and the size of the last one.'''
+    num_blocks, last_block_size = divmod(fw_size, FW_DATA_BLOCK_SIZE)
+    if last_block_size != 0:
+        num_blocks = num_blocks + 1
+    return num_blocks, last_block_size
+
+def fw_batches_read(fw_reader, fw_size: int, fw_md5):
+    '''
+    Read FW data directly into the payloads of all FW data messages (batches
+    of FW data blocks), updating the MD5 hash with each FW data block. All
+    the payloads are stored in a single contiguous buffer, and a memoryview
+    of each one is returned.
+    '''
+    pack_u8_into = struct.Struct(">B").pack_into
+    pack_u32_into = struct.Struct(">I").pack_into
+    num_blocks, _ = fw_blocks_count(fw_size)
+    num_batches, last_batch_blocks = divmod(num_blocks, FW_BLOCKS_PER_BATCH)
+    if last_batch_blocks != 0:
+        num_batches = num_batches + 1
+    fw_batches = bytearray(num_batches + (4 * num_blocks) + fw_size)
+    fw_batches_view = memoryview(fw_batches)
+    list_fw_batches = []
+    offset = 0
+    for block_start in range(0, num_blocks, FW_BLOCKS_PER_BATCH):
+        batch_start = offset
+        block_end = min(block_start + FW_BLOCKS_PER_BATCH, num_blocks)
+        pack_u8_into(fw_batches, offset, block_end - block_start)
+        offset = offset + 1
+        for block_n in range(block_start, block_end):
+            pack_u32_into(fw_batches, offset, block_n)
+            offset = offset + 4
+            block_size = min(FW_DATA_BLOCK_SIZE,
+                             fw_size - (block_n * FW_DATA_BLOCK_SIZE))
+            block = fw_batches_view[offset:offset+block_size]
+            if fw_reader.readinto(block) != block_size:
+                raise EOFError("Unexpected end of FW data")
+            fw_md5.update(block)
+            offset = offset + block_size
+        list_fw_batches.append(fw_batches_view[batch_start:offset])
+    return list_fw_batches
+
+def fw_file_read(file_path: str, compress: bool = False):
+    '''
+    Read a FW binary file into the FW data messages payloads, getting its size
+    and MD5 hash in the same pass. If compress is requested, the messages,
+    size and hash are the ones of the gzip compressed FW.
+    '''
+    fw_file = None
     try:
+        fw_md5 = hashlib.md5()
         with open(file_path, "rb") as bin_file_reader:
-            read_bytes = bin_file_reader.read()
+            fw_reader = bin_file_reader
+            if compress:
+                fw_reader = BytesIO(fw_compress(bin_file_reader.read()))
+            fw_size = fw_reader.seek(0, SEEK_END)
+            fw_reader.seek(0)
+            list_fw_batches = fw_batches_read(fw_reader, fw_size, fw_md5)
+        fw_file = (list_fw_batches, fw_size, fw_md5.digest())
     except Exception:
         logger.error(format_exc())
-        logger.error(f"Fail to read binary file {file_path}\n")
-    return read_bytes
+        logger.error("Fail to read binary file %s\n", file_path)
+    return fw_file
 
-def mqtt_publish_ota_setup(client, command):
-    logger.info(f"({len(command)}) [ {command.hex()} ]")
-    logger.info("")
-    client.publish(MQTT_TOPIC_PUB_OTA_SETUP, command)
+def bitmap_set(bitmap: bytearray, i: int):
+    '''Set bit i of a bitmap.'''
+    bitmap[i >> 3] |= 1 << (i & 7)
 
-def mqtt_publish_ota_data(client, block_n, fw_data):
-    msg_payload = bytearray()
-    msg_payload += block_n.to_bytes(4, "big")
-    msg_payload += fw_data[block_n]
-    client.publish(MQTT_TOPIC_PUB_OTA_DATA, msg_payload)
+def bitmap_is_set(bitmap: bytearray, i: int):
+    '''Check if bit i of a bitmap is set.'''
+    return bitmap[i >> 3] & (1 << (i & 7)) != 0
 
-def mqtt_force_device_check_for_update(client):
+def mqtt_publish_ota_setup(client, topic, command):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("(%d) [ %s ]", len(command), command.hex())
+        logger.debug("")
+    client.publish(topic, command)
+
+def mqtt_force_device_check_for_update(client, topic):
     '''Send MQTT msg to device to make it trigger a FW Update Check.'''
     msg_payload = bytearray(MSG_SETUP_CMD_TRIGGER_FW_UPDATE_CHECK)
     logger.info("Sending force check for FW Update "
                 "(MSG_SETUP_CMD_TRIGGER_FW_UPDATE_CHECK)")
-    mqtt_publish_ota_setup(client, msg_payload)
+    mqtt_publish_ota_setup(client, topic, msg_payload)
 
-def mqtt_send_last_fw_info(client, fw_size, fw_md5):
+def mqtt_send_last_fw_info(client, topic, fw_size, fw_md5):
     '''Send MQTT msg to device to make it trigger a FW Update Check.'''
-    msg_payload = bytearray(MSG_SETUP_CMD_LAST_FW_INFO)
-    msg_payload += FW_VER_MAJOR_FORCE_UPDATE.to_bytes(1, "big")
-    msg_payload += FW_VER_MINOR_FORCE_UPDATE.to_bytes(1, "big")
-    msg_payload += FW_VER_PATCH_FORCE_UPDATE.to_bytes(1, "big")
-    msg_payload += fw_size.to_bytes(4, "big")
-    msg_payload +=  bytearray(fw_md5.hex().encode())
+    msg_payload = MSG_SETUP_LAST_FW_INFO_STRUCT.pack(
+        MSG_SETUP_CMD_LAST_FW_INFO[0], FW_VER_MAJOR_FORCE_UPDATE,
+        FW_VER_MINOR_FORCE_UPDATE, FW_VER_PATCH_FORCE_UPDATE,
+        fw_size, fw_md5)
     logger.info("Sending last FW info (MSG_SETUP_CMD_LAST_FW_INFO)")
-    mqtt_publish_ota_setup(client, msg_payload)
+    mqtt_publish_ota_setup(client, topic, msg_payload)
 
-def mqtt_send_fuota_start(client):
+def mqtt_send_fuota_start(client, topic):
     '''Send MQTT msg to device to start the FUOTA process.'''
     msg_payload = bytearray(MSG_SETUP_CMD_FUOTA_START)
     logger.info("Sending FUOTA process start (MSG_SETUP_CMD_FUOTA_START)")
-    mqtt_publish_ota_setup(client, msg_payload)
+    mqtt_publish_ota_setup(client, topic, msg_payload)
 
 
 ###############################################################################
@@ -253,152 +366,176 @@ def mqtt_send_fuota_start(client):
 ###############################################################################
 
 def cb_mqtt_on_connect(client, userdata, flags, rc):
-    global mqtt_just_connected
     logger.info("MQTT connected to Broker")
-    client.subscribe(MQTT_TOPIC_SUB_OTA_CONTROL, qos=2)
-    client.subscribe(MQTT_TOPIC_SUB_OTA_ACK, qos=2)
-    mqtt_just_connected = True
+    # Disable Nagle's algorithm to send each MQTT msg without delay
+    client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.subscribe(userdata.topic_control, qos=2)
+    client.subscribe(userdata.topic_ack, qos=2)
+    # Notify the connection to main thread (event without topic)
+    userdata.event_queue.put((None, None))
 
 def cb_mqtt_on_msg_rx(client, userdata, msg):
-    global mqtt_msg_rx_ota_control
-    global mqtt_msg_rx_ota_ack
-    global msg_rx_payload
-    msg_rx_payload = None
-    if msg.topic == MQTT_TOPIC_SUB_OTA_CONTROL:
-        msg_rx_payload = msg.payload
-        mqtt_msg_rx_ota_control = True
-    elif msg.topic == MQTT_TOPIC_SUB_OTA_ACK:
-        msg_rx_payload = msg.payload
-        mqtt_msg_rx_ota_ack = True
+    if msg.topic in (userdata.topic_control, userdata.topic_ack):
+        userdata.event_queue.put((msg.topic, msg.payload))
     else:
         logger.warning("Msg rx on unexpected topic")
 
 
 ###############################################################################
-# MQTT Process Thread (Required to publish msg on callbacks)
+# MQTT Process (Network loop handled from the main thread)
 ###############################################################################
 
-def th_mqtt_process(client):
-    client.loop_forever()
+def mqtt_process(client):
+    '''Process MQTT network traffic and reconnect if connection is lost.'''
+    if client.loop(timeout=MQTT_LOOP_TIMEOUT) == mqtt.MQTT_ERR_SUCCESS:
+        return
+    logger.warning("MQTT disconnected, reconnecting...")
+    time.sleep(MQTT_RECONNECT_DELAY)
+    try:
+        client.reconnect()
+    except OSError:
+        logger.error("MQTT reconnection fail")
 
 
 ###############################################################################
 # Over The Air Management
 ###############################################################################
 
-def manage_ota(device_id, fw_file_path):
-    global MQTT_TOPIC_PUB_OTA_SETUP
-    global MQTT_TOPIC_PUB_OTA_DATA
-    global MQTT_TOPIC_SUB_OTA_CONTROL
-    global MQTT_TOPIC_SUB_OTA_ACK
-    global mqtt_just_connected
-    global mqtt_msg_rx_ota_control
-    global mqtt_msg_rx_ota_ack
+def manage_ota(ota_state, device_id, fw_file_path, compress=False):
     update_success = False
-    # Prepare MQTT Topics to use (add device ID to them)
-    MQTT_TOPIC_PUB_OTA_SETUP = MQTT_TOPIC_PUB_OTA_SETUP.format(device_id)
-    MQTT_TOPIC_PUB_OTA_DATA = MQTT_TOPIC_PUB_OTA_DATA.format(device_id)
-    MQTT_TOPIC_SUB_OTA_CONTROL = MQTT_TOPIC_SUB_OTA_CONTROL.format(device_id)
-    MQTT_TOPIC_SUB_OTA_ACK = MQTT_TOPIC_SUB_OTA_ACK.format(device_id)
-    logger.info(f"MQTT_TOPIC_PUB_OTA_SETUP: {MQTT_TOPIC_PUB_OTA_SETUP}")
-    logger.info(f"MQTT_TOPIC_PUB_OTA_DATA: {MQTT_TOPIC_PUB_OTA_DATA}")
-    logger.info(f"MQTT_TOPIC_SUB_OTA_CONTROL: {MQTT_TOPIC_SUB_OTA_CONTROL}")
-    logger.info(f"MQTT_TOPIC_SUB_OTA_ACK: {MQTT_TOPIC_SUB_OTA_ACK}")
-    # Read Firmware file and calculate size and number of data blocks
-    fw_data = file_read(fw_file_path)
-    if fw_data is None:
+    # Prepare MQTT Topics to use (add device ID to them), the MQTT callbacks
+    # get them from the shared FUOTA state
+    topic_setup = MQTT_TOPIC_PUB_OTA_SETUP.format(device_id)
+    topic_data = MQTT_TOPIC_PUB_OTA_DATA.format(device_id)
+    topic_control = MQTT_TOPIC_SUB_OTA_CONTROL.format(device_id)
+    topic_ack = MQTT_TOPIC_SUB_OTA_ACK.format(device_id)
+    ota_state.topic_control = topic_control
+    ota_state.topic_ack = topic_ack
+    logger.info("MQTT_TOPIC_PUB_OTA_SETUP: %s", topic_setup)
+    logger.info("MQTT_TOPIC_PUB_OTA_DATA: %s", topic_data)
+    logger.info("MQTT_TOPIC_SUB_OTA_CONTROL: %s", topic_control)
+    logger.info("MQTT_TOPIC_SUB_OTA_ACK: %s", topic_ack)
+    # Read Firmware file into FW data messages (batches of FW data blocks),
+    # and get its size and checksum
+    fw_file = fw_file_read(fw_file_path, compress)
+    if fw_file is None:
         return False
-    fw_data_md5 = hashlib.md5(fw_data).digest()
-    fw_size = len(fw_data)
-    num_blocks = int(fw_size / FW_DATA_BLOCK_SIZE)
-    last_block_size = fw_size % FW_DATA_BLOCK_SIZE
-    if last_block_size != 0:
-        num_blocks = num_blocks + 1
-    logger.info(f"Firmware: {fw_file_path}")
-    logger.info(f"Firmware MD5: {fw_data_md5.hex()}")
-    logger.info(f"Firmware size: {fw_size}")
-    # Prepare FW data blocks
-    list_fw_blocks = []
-    block_start = 0
-    block_end = FW_DATA_BLOCK_SIZE
-    for _ in range(num_blocks - 1):
-        list_fw_blocks.append(bytearray(fw_data[block_start:block_end]))
-        block_start = block_start + FW_DATA_BLOCK_SIZE
-        block_end = block_end + FW_DATA_BLOCK_SIZE
-    if last_block_size != 0:
-        list_fw_blocks.append(
-            bytearray(fw_data[block_start:block_start+last_block_size]))
-    logger.info(f"Number of blocks: {len(list_fw_blocks)}")
-    logger.info(f"Last block size: {last_block_size}")
+    list_fw_batches, fw_size, fw_data_md5 = fw_file
+    num_batches = len(list_fw_batches)
+    num_blocks, last_block_size = fw_blocks_count(fw_size)
+    logger.info("Firmware: %s", fw_file_path)
+    if compress:
+        logger.info("Firmware compressed (gzip)")
+    logger.info("Firmware MD5: %s", fw_data_md5.hex())
+    logger.info("Firmware size: %d", fw_size)
+    logger.info("Number of blocks: %d", num_blocks)
+    logger.info("Last block size: %d", last_block_size)
+    logger.info("Number of batches: %d", num_batches)
     # Launch MQTT Connection
     logger.info("Launching MQTT Connection...")
+    ev_queue = ota_state.event_queue
     mqtt_client = mqtt.Client()
+    mqtt_client.user_data_set(ota_state)
+    mqtt_client.max_inflight_messages_set(MQTT_MAX_INFLIGHT_MESSAGES)
+    mqtt_client.max_queued_messages_set(MQTT_MAX_QUEUED_MESSAGES)
     mqtt_client.on_connect = cb_mqtt_on_connect
     mqtt_client.on_message = cb_mqtt_on_msg_rx
     mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
-    th_mqtt_process_id = threading.Thread(
-        target=th_mqtt_process,
-        args=(mqtt_client,))
-    th_mqtt_process_id.start()
+    # Local reference for the FW data messages publish loop
+    publish = mqtt_client.publish
     # Manage OTA Procedure
-    block_n = 0
+    fuota_on_progress = False
+    base = 0
+    next_to_send = 0
+    acked = bytearray((num_batches + 7) // 8)
+    t0_ack = time.monotonic()
     logger.info("OTA Procedure Started")
-    while not app_exit:
+    while not ota_state.exit_flag.is_set():
+        # Fill the window of FW data batches pending to be acknowledged
+        while (fuota_on_progress and (next_to_send < base + MAX_INFLIGHT)
+                and (next_to_send < num_batches)):
+            logger.info("Sending FW batch %d", next_to_send)
+            # Paho requires a bytes payload (it doesn't accept memoryview)
+            publish(topic_data, bytes(list_fw_batches[next_to_send]))
+            next_to_send = next_to_send + 1
+        # Process MQTT until an event is received through the callbacks
+        # (loop timeout to periodically check for app exit)
+        if ev_queue.empty():
+            mqtt_process(mqtt_client)
+            # Resend FW data batches not acknowledged on time
+            if (fuota_on_progress and (base < next_to_send)
+                    and (time.monotonic() - t0_ack >= FW_ACK_TIMEOUT)):
+                logger.warning("FW data ACK timeout, resending from batch %d",
+                               base)
+                next_to_send = base
+                t0_ack = time.monotonic()
+            continue
+        topic, payload = ev_queue.get_nowait()
         # Once MQTT is connected
         # Force device to trigger a FW Update Check
-        if mqtt_just_connected:
-            mqtt_just_connected = False
-            mqtt_force_device_check_for_update(mqtt_client)
-        elif mqtt_msg_rx_ota_control:
-            mqtt_msg_rx_ota_control = False
-            if msg_rx_payload is None:
+        if topic is None:
+            mqtt_force_device_check_for_update(mqtt_client, topic_setup)
+        elif topic == topic_control:
+            if payload is None:
                 continue
-            cmd = list(msg_rx_payload)
             # Device Request check FW Update (get last FW information)
-            if cmd == MSG_CONTROL_CMD_FW_UPDATE_CHECK:
+            if payload == MSG_CONTROL_CMD_FW_UPDATE_CHECK:
                 logger.info("Device request last available FW information")
-                mqtt_send_last_fw_info(mqtt_client, fw_size, fw_data_md5)
+                mqtt_send_last_fw_info(mqtt_client, topic_setup, fw_size,
+                                       fw_data_md5)
             # Device request to launch a FUOTA process to Server
-            elif cmd == MSG_CONTROL_CMD_REQUEST_FW_UPDATE:
+            elif payload == MSG_CONTROL_CMD_REQUEST_FW_UPDATE:
                 logger.info("Device request a FW Update")
-                mqtt_send_fuota_start(mqtt_client)
+                mqtt_send_fuota_start(mqtt_client, topic_setup)
             # Device ready to start FUOTA process
-            elif cmd == MSG_ACK_FUOTA_START:
-                # Send first FW data block
-                block_n = 0
-                logger.info(f"Sending FW block {block_n}")
-                mqtt_publish_ota_data(mqtt_client, block_n, list_fw_blocks)
-                block_n = block_n + 1
+            elif payload == MSG_ACK_FUOTA_START:
+                # Start sending FW data batches from the first one
+                fuota_on_progress = True
+                base = 0
+                next_to_send = 0
+                acked = bytearray((num_batches + 7) // 8)
+                t0_ack = time.monotonic()
             # FUOTA process completed successfully
-            elif cmd == MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_OK:
+            elif payload == MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_OK:
                 logger.info("Device notify Firmware Update completed")
                 update_success = True
                 break
             # FUOTA process completed but update on device has fail
-            elif cmd == MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_FAIL:
+            elif payload == MSG_CONTROL_CMD_FW_UPDATE_COMPLETED_FAIL:
                 logger.info("Device notify Firmware Update fail")
                 break
             else:
                 logger.warning("Unkown command received from Device")
-        elif mqtt_msg_rx_ota_ack:
-            mqtt_msg_rx_ota_ack = False
-            if msg_rx_payload is None:
+        elif topic == topic_ack:
+            if payload is None:
                 continue
-            ack_block_n = int.from_bytes(msg_rx_payload, "big")
-            if ack_block_n != (block_n - 1):
-                logger.error("Received ACK of unexpected FW block")
-                logger.error(f"Expected {block_n}, received {ack_block_n}")
-                break
-            if block_n < num_blocks:
-                logger.info(f"Sending FW block {block_n}")
-                mqtt_publish_ota_data(mqtt_client, block_n, list_fw_blocks)
-                block_n = block_n + 1
-    # Close MQTT and wait for process thread end
+            # Device acknowledges the last FW block written of each batch (the
+            # ACK also covers any previous batch that has not been
+            # acknowledged)
+            ack_block_n = int.from_bytes(payload, "big")
+            ack_batch_n = ack_block_n // FW_BLOCKS_PER_BATCH
+            ack_batch_end = min((ack_batch_n + 1) * FW_BLOCKS_PER_BATCH,
+                                num_blocks)
+            # Ignore ACKs of unknown FW data or FW data not written completely
+            if ((ack_batch_n >= num_batches)
+                    or (ack_block_n != ack_batch_end - 1)):
+                logger.warning("Received ACK of unexpected FW block %d",
+                               ack_block_n)
+                continue
+            # Ignore duplicated ACKs (i.e. from resent FW data batches)
+            if bitmap_is_set(acked, ack_batch_n):
+                logger.debug("Received duplicated ACK of FW block %d",
+                             ack_block_n)
+                continue
+            for batch_n in range(base, ack_batch_n + 1):
+                bitmap_set(acked, batch_n)
+            while (base < num_batches) and bitmap_is_set(acked, base):
+                base = base + 1
+            next_to_send = max(next_to_send, base)
+            t0_ack = time.monotonic()
+    # Close MQTT
     logger.info("Disconnecting from MQTT")
     mqtt_client.disconnect()
-    mqtt_client.loop_stop()
-    if th_mqtt_process_id.is_alive():
-        th_mqtt_process_id.join()
     logger.info("MQTT Closed")
     return update_success
 
@@ -417,6 +554,10 @@ def parse_options():
     parser.add_argument("--firmware", action="store", type=str,
                         help="Specify the firmware application binary "
                              "file to send through OTA-MQTT.")
+    parser.add_argument("--compress", action="store_true",
+                        help="Compress the firmware with gzip before send "
+                             "it (the device must support gzip compressed "
+                             "firmware images, like ESP8266).")
     args = parser.parse_args()
     return args
 
@@ -428,7 +569,10 @@ def parse_options():
 def main(argc, argv):
     args = parse_options()
     if args.device and args.firmware:
-        if not manage_ota(args.device, args.firmware):
+        ota_state = OtaState()
+        system_termination_signal_setup(ota_state)
+        if not manage_ota(ota_state, args.device, args.firmware,
+                          args.compress):
             return 1
     return 0
 
@@ -437,24 +581,24 @@ def main(argc, argv):
 # System Termination Signals Management
 ###############################################################################
 
-def system_termination_signal_handler(signal,  frame):
+def system_termination_signal_handler(ota_state, signal,  frame):
     '''Termination signals detection handler. It stop application execution.'''
-    global app_exit
-    app_exit = True
+    ota_state.exit_flag.set()
 
 
-def system_termination_signal_setup():
+def system_termination_signal_setup(ota_state):
     '''
     Attachment of System termination signals (SIGINT, SIGTERM, SIGUSR1) to
     function handler.
     '''
+    signal_handler = partial(system_termination_signal_handler, ota_state)
     # SIGTERM (kill pid) to signal_handler
-    signal(SIGTERM, system_termination_signal_handler)
+    signal(SIGTERM, signal_handler)
     # SIGINT (Ctrl+C) to signal_handler
-    signal(SIGINT, system_termination_signal_handler)
+    signal(SIGINT, signal_handler)
     # SIGUSR1 (self-send) to signal_handler
     if os_system() != "Windows":
-        signal(SIGUSR1, system_termination_signal_handler)
+        signal(SIGUSR1, signal_handler)
 
 
 ###############################################################################
@@ -463,7 +607,6 @@ def system_termination_signal_setup():
 
 if __name__ == '__main__':
     logger.info("{} v{} {}\n".format(os_path.basename(NAME), VERSION, DATE))
-    system_termination_signal_setup()
     return_code = main(len(sys_argv) - 1, sys_argv[1:])
-    logger.info(f"Exit ({return_code})")
+    logger.info("Exit (%d)", return_code)
     sys_exit(return_code)